@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+from typing import List, Optional
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorCollection
+from bson.errors import InvalidDocument
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from app.db import db
+
+logger = logging.getLogger(__name__)
+
+# Queue and flush tuning (overridable via .env)
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", "10000"))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "500"))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "1.0"))
+AUDIT_TTL_DAYS = int(os.getenv("AUDIT_TTL_DAYS", "90"))
+
+# Outcomes recorded for each service invocation
+ALLOWED = "allowed"
+NOT_IN_PLAN = "not_in_plan"
+QUOTA_EXCEEDED = "quota_exceeded"
+
+# Bounds applied to caller-supplied fields so every record stays encodable
+_MAX_UNITS = 2**63 - 1
+_MAX_SERVICE_LEN = 256
+_DUPLICATE_KEY = 11000
+
+# Marks the end of the queue so the writer can drain and exit
+_STOP = object()
+
+
+class AuditLog:
+    """
+    In-process buffer for service invocation records.
+
+    The request path calls `record()`, which never awaits; a background task
+    writes the buffered records to MongoDB with `insert_many` in batches of
+    at most `batch_size`, or whatever has arrived after `flush_interval`
+    seconds. When the queue is full, records are dropped and counted.
+    """
+
+    def __init__(
+        self,
+        collection: AsyncIOMotorCollection,
+        maxsize: int = AUDIT_QUEUE_SIZE,
+        batch_size: int = AUDIT_BATCH_SIZE,
+        flush_interval: float = AUDIT_FLUSH_INTERVAL,
+        ttl_days: int = AUDIT_TTL_DAYS,
+    ):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.ttl_days = ttl_days
+        self.dropped = 0
+        self._maxsize = maxsize
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, user_id: ObjectId, service_name: str, outcome: str, units: int = 1) -> None:
+        """Queue one invocation record without blocking the caller."""
+        if self._queue is None or self._task is None:
+            self.dropped += 1
+            return
+        entry = {
+            "user_id": user_id,
+            "service": str(service_name)[:_MAX_SERVICE_LEN],
+            "outcome": outcome,
+            "units": max(0, min(int(units), _MAX_UNITS)),
+            "ts": datetime.now(timezone.utc),
+        }
+        try:
+            self._queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def start(self) -> None:
+        # Expire old records so the collection stays bounded
+        ttl = self.ttl_days * 86400
+        try:
+            await self.collection.create_index("ts", expireAfterSeconds=ttl)
+        except OperationFailure:
+            # The index exists with another TTL; apply the configured one in place
+            try:
+                await self.collection.database.command(
+                    "collMod", self.collection.name,
+                    index={"keyPattern": {"ts": 1}, "expireAfterSeconds": ttl},
+                )
+            except OperationFailure:
+                logger.exception("Could not update audit log TTL; keeping the existing index")
+        self._queue = asyncio.Queue(maxsize=self._maxsize)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Flush everything still queued, then stop the writer."""
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        # Blocks only while the queue is full; the writer keeps draining it
+        await self._queue.put(_STOP)
+        await task
+        if self.dropped:
+            logger.warning("Audit log dropped %d records", self.dropped)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            stopping = False
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+            if stopping:
+                return
+
+    async def _flush(self, batch: List[dict], retry: bool = True) -> None:
+        try:
+            await self.collection.insert_many(batch, ordered=False)
+        except BulkWriteError as exc:
+            # Unordered: everything else was written. Duplicate keys come from
+            # a retry of records that already made it in.
+            failed = [e for e in exc.details.get("writeErrors", []) if e.get("code") != _DUPLICATE_KEY]
+            if failed:
+                logger.error("Failed to write %d audit records: %s", len(failed), failed[0].get("errmsg"))
+                self.dropped += len(failed)
+        except (InvalidDocument, OverflowError):
+            # Nothing was sent; split the batch so only the bad record is dropped
+            if len(batch) == 1:
+                logger.exception("Dropping unencodable audit record")
+                self.dropped += 1
+                return
+            mid = len(batch) // 2
+            await self._flush(batch[:mid], retry)
+            await self._flush(batch[mid:], retry)
+        except Exception:
+            # Never let a write failure kill the writer task
+            if retry:
+                logger.warning("Failed to write %d audit records, retrying", len(batch), exc_info=True)
+                await asyncio.sleep(self.flush_interval)
+                await self._flush(batch, retry=False)
+                return
+            logger.exception("Failed to write %d audit records", len(batch))
+            self.dropped += len(batch)
+
+audit_log = AuditLog(db.audit_log)
@@ -14,18 +14,73 @@ from app.db import get_database
 SECRET_KEY = os.getenv("JWT_SECRET", "change-me")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
+# Refreshed tokens never outlive this, counted from the original login
+TOKEN_MAX_LIFETIME_MINUTES = int(os.getenv("JWT_MAX_LIFETIME_MINUTES", "480"))
+# Embed a signed snapshot of the user's plan in issued tokens
+EMBED_ENTITLEMENTS = os.getenv("JWT_EMBED_ENTITLEMENTS", "false").lower() in ("1", "true", "yes")
 
 # Password hashing context
 pwd_ctx = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token")
 
 # JWT creation
-def create_access_token(subject: str, role: str, expires_delta: Optional[timedelta] = None) -> str:
-    to_encode = {"sub": subject, "role": role}
-    expire = datetime.now(timezone.utc) + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+def create_access_token(
+    subject: str,
+    role: str,
+    expires_delta: Optional[timedelta] = None,
+    entitlements: Optional[dict] = None,
+    auth_time: Optional[datetime] = None,
+) -> str:
+    now = datetime.now(timezone.utc)
+    auth_time = auth_time or now
+    to_encode = {"sub": subject, "role": role, "auth_time": int(auth_time.timestamp())}
+    if entitlements is not None:
+        to_encode["ent"] = entitlements
+    expire = now + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+    # Never extend a session past its maximum lifetime
+    expire = min(expire, auth_time + timedelta(minutes=TOKEN_MAX_LIFETIME_MINUTES))
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
+# Entitlements
+def entitlement_claims(plan: dict) -> dict:
+    """Compact snapshot of a plan: id, version, service->limit map, lease block and unit costs."""
+    claims = {
+        "pid": str(plan["_id"]),
+        "ver": plan.get("version", 0),
+        "lim": plan.get("limits", {}),
+    }
+    if plan.get("lease_block"):
+        claims["lb"] = plan["lease_block"]
+    if plan.get("costs"):
+        claims["cost"] = plan["costs"]
+    return claims
+
+async def issue_token(db: AsyncIOMotorDatabase, user: dict, auth_time: Optional[datetime] = None) -> str:
+    entitlements = None
+    if EMBED_ENTITLEMENTS:
+        sub = await db.subscriptions.find_one({"user_id": user["_id"]})
+        plan = await db.plans.find_one({"_id": sub["plan_id"]}) if sub else None
+        if plan:
+            entitlements = entitlement_claims(plan)
+            # Backfill users recorded before plan tracking. Only fill in a missing
+            # snapshot or move the same plan forward; never lower the version, or a
+            # concurrent plan update could be undone.
+            await db.users.update_one(
+                {
+                    "_id": user["_id"],
+                    "$or": [
+                        {"plan_id": {"$exists": False}},
+                        {"plan_id": plan["_id"], "plan_version": {"$exists": False}},
+                        {"plan_id": plan["_id"], "plan_version": {"$lt": entitlements["ver"]}},
+                    ],
+                },
+                {"$set": {"plan_id": plan["_id"], "plan_version": entitlements["ver"]}}
+            )
+    return create_access_token(
+        str(user["_id"]), user.get("role", "customer"), entitlements=entitlements, auth_time=auth_time
+    )
+
 # Authentication dependencies
 async def get_current_user(
     token: str = Depends(oauth2_scheme),
@@ -40,6 +95,8 @@ async def get_current_user(
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id: str = payload.get("sub")
         role: str = payload.get("role")
+        entitlements: Optional[dict] = payload.get("ent")
+        auth_time: Optional[int] = payload.get("auth_time")
         if not user_id or not role:
             raise credentials_exc
     except JWTError:
@@ -56,8 +113,39 @@ async def get_current_user(
         raise credentials_exc
 
     user["role"] = role
+    user["entitlements"] = entitlements
+    user["auth_time"] = auth_time
     return user
 
+async def get_entitlements(
+    current_user: dict = Depends(get_current_user),
+    db: AsyncIOMotorDatabase = Depends(get_database)
+) -> dict:
+    """
+    Return the current user's plan entitlements, from the token when it carries
+    them and otherwise from the subscription and plan records.
+    """
+    claims = current_user.get("entitlements")
+    if claims is not None:
+        # Reject tokens issued before a plan assignment or plan change
+        plan_id = current_user.get("plan_id")
+        current_pid = str(plan_id) if plan_id else None
+        if claims.get("pid") != current_pid or claims.get("ver") != current_user.get("plan_version"):
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Entitlements are out of date, refresh your token",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+        return claims
+
+    sub = await db.subscriptions.find_one({"user_id": current_user["_id"]})
+    if not sub:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="No subscription found for user")
+    plan = await db.plans.find_one({"_id": sub["plan_id"]})
+    if not plan:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Plan configuration missing")
+    return entitlement_claims(plan)
+
 async def get_admin_user(current_user: dict = Depends(get_current_user)):
     if current_user.get("role") != "admin":
         raise HTTPException(
@@ -81,5 +169,39 @@ async def login(
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    token = create_access_token(str(user["_id"]), user.get("role", "customer"))
+    token = await issue_token(db, user)
+    return {"access_token": token, "token_type": "bearer"}
+
+@auth_router.post("/refresh")
+async def refresh_token(
+    current_user: dict = Depends(get_current_user),
+    db: AsyncIOMotorDatabase = Depends(get_database)
+):
+    """
+    Reissue the caller's token with up-to-date entitlements. The new token keeps
+    the original login time, so refreshing cannot extend a session indefinitely.
+    """
+    auth_time = current_user.get("auth_time")
+    if auth_time is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Token cannot be refreshed, log in again",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    auth_time = datetime.fromtimestamp(auth_time, tz=timezone.utc)
+    if datetime.now(timezone.utc) >= auth_time + timedelta(minutes=TOKEN_MAX_LIFETIME_MINUTES):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Session expired, log in again",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    # Sign the stored role, not the one claimed by the presented token
+    user = await db.users.find_one({"_id": current_user["_id"]})
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    token = await issue_token(db, user, auth_time=auth_time)
     return {"access_token": token, "token_type": "bearer"}
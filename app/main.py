@@ -1,12 +1,24 @@
 # app/main.py
 import uvicorn
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from app.db import db
+from app.audit import audit_log
+from app.quota import quota_leases
 from app.routers import plans, permissions, subscriptions, usage, access, services, users
 from app.auth import auth_router
 from app.routers.services import router as service_router
 
-app = FastAPI(title="Cloud Service Access MGMT")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # start background workers; on shutdown return leased quota and drain the audit log
+    await audit_log.start()
+    await quota_leases.start()
+    yield
+    await quota_leases.stop()
+    await audit_log.stop()
+
+app = FastAPI(title="Cloud Service Access MGMT", lifespan=lifespan)
 
 # auth (login, token)
 app.include_router(auth_router)
@@ -31,6 +31,9 @@ class PlanModel(BaseModel):
     description: str
     permissions: List[PyObjectId]
     limits: Dict[str, int]
+    lease_block: Optional[int] = None
+    costs: Dict[str, int] = {}
+    version: int = 0
 
 class PermissionModel(BaseModel):
     model_config = ConfigDict(arbitrary_types_allowed=True)
@@ -0,0 +1,279 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from app.db import db
+
+logger = logging.getLogger(__name__)
+
+# Seconds a worker may hold reserved quota before returning the unused part
+QUOTA_LEASE_TTL = float(os.getenv("QUOTA_LEASE_TTL", "30"))
+
+
+async def get_usage_record(
+    collection: AsyncIOMotorCollection,
+    user_id: ObjectId,
+    service_name: str,
+    now: datetime,
+) -> dict:
+    """Fetch the user's usage record for this month, resetting or creating it as needed."""
+    # Single upsert backed by the unique (user_id, permission_name) index
+    try:
+        usage = await collection.find_one_and_update(
+            {"user_id": user_id, "permission_name": service_name},
+            {"$setOnInsert": {"count": 0, "last_reset": now}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        # A concurrent upsert created it first
+        usage = await collection.find_one({"user_id": user_id, "permission_name": service_name})
+    last_reset = usage.get("last_reset")
+    if last_reset and (last_reset.year != now.year or last_reset.month != now.month):
+        # Reset monthly counter, unless another worker already did
+        await collection.update_one(
+            {"_id": usage["_id"], "last_reset": last_reset},
+            {"$set": {"count": 0, "last_reset": now}}
+        )
+        usage = await collection.find_one({"_id": usage["_id"]})
+    return usage
+
+
+async def debit_usage(
+    collection: AsyncIOMotorCollection,
+    user_id: ObjectId,
+    service_name: str,
+    limit: int,
+    amount: int,
+    now: datetime,
+) -> Optional[int]:
+    """
+    Atomically add `amount` to this month's usage if the whole amount fits
+    under `limit`. Returns the new count, or None when it does not fit.
+    """
+    usage = await get_usage_record(collection, user_id, service_name, now)
+    doc = await collection.find_one_and_update(
+        {"_id": usage["_id"], "count": {"$lte": limit - amount}},
+        {"$inc": {"count": amount}},
+        return_document=ReturnDocument.AFTER,
+    )
+    return doc["count"] if doc else None
+
+
+async def refund_usage(
+    collection: AsyncIOMotorCollection,
+    user_id: ObjectId,
+    service_name: str,
+    amount: int,
+    now: datetime,
+) -> None:
+    """Give back units debited this month; a no-op once the counter has been reset."""
+    month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    await collection.update_one(
+        {
+            "user_id": user_id,
+            "permission_name": service_name,
+            "last_reset": {"$gte": month_start},
+            "count": {"$gte": amount},
+        },
+        {"$inc": {"count": -amount}},
+    )
+
+
+class _Lease:
+    """A block of quota reserved in a usage record and served from memory."""
+
+    __slots__ = ("usage_id", "last_reset", "count", "remaining", "expires_at")
+
+    def __init__(self, usage_id: ObjectId, last_reset: datetime, count: int, granted: int, ttl: float):
+        self.usage_id = usage_id
+        self.last_reset = last_reset
+        # usage count in the DB right after the reservation
+        self.count = count
+        self.remaining = granted
+        self.expires_at = time.monotonic() + ttl
+
+    def usable(self, now: datetime) -> bool:
+        return (
+            self.remaining > 0
+            and time.monotonic() < self.expires_at
+            and self.last_reset.year == now.year
+            and self.last_reset.month == now.month
+        )
+
+    def take(self, amount: int) -> int:
+        """Consume `amount` units and return the usage count as seen by this worker."""
+        self.remaining -= amount
+        return self.count - self.remaining
+
+
+class QuotaLeaseManager:
+    """
+    Serves quota from blocks reserved in the `usage` collection.
+
+    A reservation atomically adds up to `block` units to the usage count,
+    never past the plan limit, so the count in the DB is always an upper
+    bound on what has been served. Unused units are given back when the
+    lease expires, when the month rolls over, or on shutdown.
+    """
+
+    def __init__(self, collection: AsyncIOMotorCollection, ttl: float = QUOTA_LEASE_TTL):
+        self.collection = collection
+        self.ttl = ttl
+        self._leases: Dict[Tuple[ObjectId, str], _Lease] = {}
+        self._locks: Dict[Tuple[ObjectId, str], asyncio.Lock] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = asyncio.Event()
+
+    async def consume(
+        self, user_id: ObjectId, service_name: str, limit: int, block: int, amount: int = 1
+    ) -> Optional[int]:
+        """
+        Take `amount` units of quota. Returns the usage count after this call,
+        or None when the whole amount does not fit under the monthly limit.
+        """
+        key = (user_id, service_name)
+        now = datetime.now(timezone.utc)
+        lease = self._leases.get(key)
+        if lease and lease.usable(now) and lease.remaining >= amount:
+            return lease.take(amount)
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            # Another request may have renewed the lease while we waited
+            lease = self._leases.get(key)
+            if lease and lease.usable(now) and lease.remaining >= amount:
+                return lease.take(amount)
+            if lease:
+                await self._retire(key, lease)
+
+            usage = await get_usage_record(self.collection, user_id, service_name, now)
+            lease = await self._reserve(usage, limit, max(block, amount), amount)
+            if lease is None:
+                return None
+            self._install(key, lease)
+            return lease.take(amount)
+
+    def _install(self, key: Tuple[ObjectId, str], lease: _Lease) -> None:
+        # A lease installed meanwhile (e.g. under a lock the sweep dropped)
+        # is folded in rather than overwritten, so its units are not lost
+        existing = self._leases.get(key)
+        if (
+            existing is not None
+            and existing is not lease
+            and existing.usage_id == lease.usage_id
+            and existing.last_reset == lease.last_reset
+        ):
+            lease.remaining += existing.remaining
+            existing.remaining = 0
+        self._leases[key] = lease
+
+    async def _retire(self, key: Tuple[ObjectId, str], lease: _Lease) -> None:
+        """Return a lease's unused units; keep the lease if that fails so it is retried."""
+        # Unpublish first so no request takes units that are being returned
+        if self._leases.get(key) is lease:
+            del self._leases[key]
+        try:
+            # Shielded: if the caller is cancelled the write still completes
+            await asyncio.shield(self._release(lease))
+        except Exception:
+            self._install(key, lease)
+            raise
+
+    async def refund(self, user_id: ObjectId, service_name: str, amount: int) -> None:
+        """Give back units taken by `consume` that ended up not being used."""
+        now = datetime.now(timezone.utc)
+        lease = self._leases.get((user_id, service_name))
+        if lease and lease.last_reset.year == now.year and lease.last_reset.month == now.month:
+            lease.remaining += amount
+            return
+        await refund_usage(self.collection, user_id, service_name, amount, now)
+
+    async def _reserve(self, usage: dict, limit: int, block: int, need: int) -> Optional[_Lease]:
+        count = usage.get("count", 0)
+        while True:
+            grant = min(block, limit - count)
+            if grant < need:
+                return None
+            # Only succeeds if the grant still fits under the limit
+            doc = await self.collection.find_one_and_update(
+                {"_id": usage["_id"], "count": {"$lte": limit - grant}},
+                {"$inc": {"count": grant}},
+                return_document=ReturnDocument.AFTER,
+            )
+            if doc:
+                return _Lease(doc["_id"], doc["last_reset"], doc["count"], grant, self.ttl)
+            current = await self.collection.find_one({"_id": usage["_id"]})
+            if not current:
+                return None
+            count = current.get("count", 0)
+
+    async def _release(self, lease: _Lease) -> None:
+        if lease.remaining <= 0:
+            return
+        # Skip the refund if the counter was reset for a new month meanwhile
+        await self.collection.update_one(
+            {"_id": lease.usage_id, "last_reset": lease.last_reset},
+            {"$inc": {"count": -lease.remaining}},
+        )
+        lease.remaining = 0
+
+    async def start(self) -> None:
+        # One usage record per (user, service), so counters never split
+        try:
+            await self.collection.create_index(
+                [("user_id", 1), ("permission_name", 1)], unique=True
+            )
+        except OperationFailure:
+            logger.exception("Could not create unique usage index; merge duplicate usage records")
+        self._stopping.clear()
+        self._task = asyncio.create_task(self._sweep())
+
+    async def stop(self) -> None:
+        """Return all unused allowance."""
+        if self._task is not None:
+            # Let the sweep finish any release in flight rather than cancelling it
+            self._stopping.set()
+            await self._task
+            self._task = None
+        for key, lease in list(self._leases.items()):
+            async with self._locks.setdefault(key, asyncio.Lock()):
+                if self._leases.get(key) is not lease:
+                    continue
+                try:
+                    await self._retire(key, lease)
+                except Exception:
+                    logger.exception("Failed to return leased quota for usage %s", lease.usage_id)
+
+    async def _sweep(self) -> None:
+        # Return allowance held for users who stopped calling
+        while True:
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.ttl)
+            except asyncio.TimeoutError:
+                pass
+            if self._stopping.is_set():
+                return
+            now = datetime.now(timezone.utc)
+            for key, lease in list(self._leases.items()):
+                if lease.usable(now):
+                    continue
+                lock = self._locks.setdefault(key, asyncio.Lock())
+                async with lock:
+                    if self._leases.get(key) is lease:
+                        try:
+                            await self._retire(key, lease)
+                        except Exception:
+                            logger.exception("Failed to return leased quota for usage %s", lease.usage_id)
+                # Forget idle keys so the lock table does not grow without bound
+                if key not in self._leases and not lock.locked():
+                    self._locks.pop(key, None)
+
+quota_leases = QuotaLeaseManager(db.usage)
@@ -1,7 +1,7 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from bson import ObjectId
-from app.auth import get_current_user
+from app.auth import get_current_user, get_entitlements
 from app.db import get_database
 
 router = APIRouter(prefix="/access", tags=["access"])
@@ -10,6 +10,7 @@ router = APIRouter(prefix="/access", tags=["access"])
 async def check_access(
     service_name: str,
     current_user: dict = Depends(get_current_user),
+    entitlements: dict = Depends(get_entitlements),
     db: AsyncIOMotorDatabase = Depends(get_database)
 ):
     """
@@ -23,32 +24,25 @@ async def check_access(
         except Exception:
             raise HTTPException(status.HTTP_400_BAD_REQUEST, detail="Invalid user ID")
 
-    # 1) Load subscription
-    sub = await db.subscriptions.find_one({"user_id": user_id})
-    if not sub:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="No subscription found for user")
-
-    # 2) Load plan
-    plan = await db.plans.find_one({"_id": sub["plan_id"]})
-    if not plan:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Plan configuration missing")
-
-    # 3) Check permission inclusion
-    limits = plan.get("limits", {})
+    # 1) Check permission inclusion
+    limits = entitlements["lim"]
     if service_name not in limits:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"Service '{service_name}' not in your plan")
 
-    # 4) Fetch usage (no increment)
+    # 2) Fetch usage (no increment)
     usage_record = await db.usage.find_one({
         "user_id": user_id,
         "permission_name": service_name
     })
     used = usage_record.get("count", 0) if usage_record else 0
     limit = limits[service_name]
+    # One call is charged at the plan's unit cost for this service
+    cost = entitlements.get("cost", {}).get(service_name, 1)
 
     return {
         "service": service_name,
-        "allowed": used < limit,
+        "allowed": used + cost <= limit,
         "limit": limit,
-        "used": used
+        "used": used,
+        "cost": cost
     }
@@ -2,6 +2,7 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from typing import List
 from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReturnDocument
 from app.schemas import PlanCreate, PlanOut
 from app.db import get_database
 from app.auth import get_admin_user
@@ -22,6 +23,8 @@ async def create_plan(
     doc = plan_in.dict()
     # Convert permission IDs into ObjectId instances
     doc["permissions"] = [ObjectId(pid) for pid in doc.pop("permission_ids")]
+    # Bumped on every change so tokens carrying the old plan go stale
+    doc["version"] = 1
 
     # Insert into database
     res = await db.plans.insert_one(doc)
@@ -59,6 +62,35 @@ async def get_plan(
     plan["permissions"] = [str(pid) for pid in plan.get("permissions", [])]
     return PlanOut(**plan)
 
+@router.put("/{plan_id}", response_model=PlanOut)
+async def update_plan(
+    plan_id: str,
+    plan_in: PlanCreate,
+    db: AsyncIOMotorDatabase = Depends(get_database),
+    admin=Depends(get_admin_user)
+):
+    # Prevent renaming onto another plan's name
+    if await db.plans.find_one({"name": plan_in.name, "_id": {"$ne": ObjectId(plan_id)}}):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Plan name already exists")
+
+    update_data = plan_in.dict()
+    update_data["permissions"] = [ObjectId(pid) for pid in update_data.pop("permission_ids")]
+    updated = await db.plans.find_one_and_update(
+        {"_id": ObjectId(plan_id)},
+        {"$set": update_data, "$inc": {"version": 1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not updated:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Plan not found")
+    # Invalidate entitlement claims issued for the previous version
+    await db.users.update_many(
+        {"plan_id": updated["_id"]},
+        {"$set": {"plan_version": updated["version"]}}
+    )
+    updated["_id"] = str(updated["_id"])
+    updated["permissions"] = [str(pid) for pid in updated.get("permissions", [])]
+    return PlanOut(**updated)
+
 @router.delete("/{plan_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_plan(
     plan_id: str,
@@ -68,4 +100,9 @@ async def delete_plan(
     res = await db.plans.delete_one({"_id": ObjectId(plan_id)})
     if res.deleted_count == 0:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Plan not found")
+    # Invalidate entitlement claims issued for the deleted plan
+    await db.users.update_many(
+        {"plan_id": ObjectId(plan_id)},
+        {"$unset": {"plan_id": "", "plan_version": ""}}
+    )
     return
@@ -1,66 +1,131 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+import logging
+from fastapi import APIRouter, Depends, HTTPException, Query, status
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from bson import ObjectId
 from datetime import datetime, timezone
+from typing import Optional
 from app.db import get_database
-from app.auth import get_current_user
+from app.auth import get_current_user, get_entitlements
+from app.audit import audit_log, ALLOWED, NOT_IN_PLAN, QUOTA_EXCEEDED
+from app.quota import debit_usage, refund_usage, quota_leases
+from app.schemas import ServiceBatchRequest, MAX_UNITS
 
+logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/services", tags=["services"])
 
-@router.get("/{service_name}")
-async def invoke_service(
-    service_name: str,
-    current_user: dict = Depends(get_current_user),
-    db: AsyncIOMotorDatabase = Depends(get_database)
-):
-    # 1) Load subscription for this user
+def _resolve_user_id(current_user: dict) -> ObjectId:
     user_id = current_user.get("_id")
     if isinstance(user_id, str):
         try:
             user_id = ObjectId(user_id)
         except:
             raise HTTPException(status.HTTP_400_BAD_REQUEST, "Invalid user ID")
+    return user_id
 
-    sub = await db.subscriptions.find_one({"user_id": user_id})
-    if not sub:
-        raise HTTPException(status.HTTP_403_FORBIDDEN, detail="No subscription found for user")
+async def _debit(
+    db: AsyncIOMotorDatabase, user_id: ObjectId, service_name: str, limit: int, amount: int, block: Optional[int]
+) -> Optional[int]:
+    # Serve from a quota lease on high-volume plans, otherwise debit the usage record directly
+    if block:
+        return await quota_leases.consume(user_id, service_name, limit, block, amount)
+    return await debit_usage(db.usage, user_id, service_name, limit, amount, datetime.now(timezone.utc))
+
+async def _refund(
+    db: AsyncIOMotorDatabase, user_id: ObjectId, service_name: str, amount: int, block: Optional[int]
+):
+    if block:
+        await quota_leases.refund(user_id, service_name, amount)
+    else:
+        await refund_usage(db.usage, user_id, service_name, amount, datetime.now(timezone.utc))
+
+@router.post("/batch")
+async def invoke_services_batch(
+    batch: ServiceBatchRequest,
+    current_user: dict = Depends(get_current_user),
+    entitlements: dict = Depends(get_entitlements),
+    db: AsyncIOMotorDatabase = Depends(get_database)
+):
+    """
+    Invoke several services in one request. Either every item is charged or,
+    if any item does not fit in its remaining quota, none are.
+    """
+    user_id = _resolve_user_id(current_user)
+    limits = entitlements["lim"]
+    costs = entitlements.get("cost", {})
+    block = entitlements.get("lb")
 
-    # 2) Load plan and limits
-    plan = await db.plans.find_one({"_id": sub["plan_id"]})
-    if not plan:
-        raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Plan configuration missing")
-    limits = plan.get("limits", {})
+    # 1) Every service must be in the plan before anything is charged
+    for item in batch.items:
+        if item.service not in limits:
+            audit_log.record(user_id, item.service, NOT_IN_PLAN, item.units * costs.get(item.service, 1))
+            raise HTTPException(status.HTTP_403_FORBIDDEN, detail=f"Service '{item.service}' not in your plan")
+
+    # 2) Debit each counter, rolling back if one does not fit or the debit fails
+    charged = []
+    try:
+        for item in batch.items:
+            amount = item.units * costs.get(item.service, 1)
+            limit = limits[item.service]
+            # An amount larger than the whole limit can never fit
+            used = None
+            if amount <= limit:
+                used = await _debit(db, user_id, item.service, limit, amount, block)
+            if used is None:
+                audit_log.record(user_id, item.service, QUOTA_EXCEEDED, amount)
+                raise HTTPException(
+                    status.HTTP_429_TOO_MANY_REQUESTS, detail=f"Monthly quota exceeded for {item.service}"
+                )
+            charged.append({
+                "service": item.service,
+                "units": item.units,
+                "charged": amount,
+                "usage_this_month": used,
+                "data": f"🚀 Simulated result from {item.service}"
+            })
+    except BaseException:
+        for done in charged:
+            try:
+                await _refund(db, user_id, done["service"], done["charged"], block)
+            except Exception:
+                logger.exception("Failed to refund %d units of %s", done["charged"], done["service"])
+        raise
+
+    for done in charged:
+        audit_log.record(user_id, done["service"], ALLOWED, done["charged"])
+    return {"results": charged}
+
+@router.get("/{service_name}")
+async def invoke_service(
+    service_name: str,
+    units: int = Query(1, ge=1, le=MAX_UNITS),
+    current_user: dict = Depends(get_current_user),
+    entitlements: dict = Depends(get_entitlements),
+    db: AsyncIOMotorDatabase = Depends(get_database)
+):
+    # 1) Resolve the user id
+    user_id = _resolve_user_id(current_user)
+
+    # 2) Check the service against the plan limits
+    limits = entitlements["lim"]
+    amount = units * entitlements.get("cost", {}).get(service_name, 1)
     if service_name not in limits:
+        audit_log.record(user_id, service_name, NOT_IN_PLAN, amount)
         raise HTTPException(status.HTTP_403_FORBIDDEN, detail=f"Service '{service_name}' not in your plan")
     limit = limits[service_name]
 
-    # 3) Fetch or initialize usage record
-    now = datetime.now(timezone.utc)
-    usage = await db.usage.find_one({
-        "user_id": user_id,
-        "permission_name": service_name
-    })
-    if usage:
-        last_reset = usage.get("last_reset")
-        if last_reset and (last_reset.year != now.year or last_reset.month != now.month):
-            # Reset monthly counter
-            await db.usage.update_one({"_id": usage["_id"]}, {"$set": {"count": 0, "last_reset": now}})
-            usage = None
-    if not usage:
-        # Create new usage doc
-        usage_doc = {"user_id": user_id, "permission_name": service_name, "count": 0, "last_reset": now}
-        res = await db.usage.insert_one(usage_doc)
-        usage = await db.usage.find_one({"_id": res.inserted_id})
-
-    # 4) Enforce quota
-    used = usage.get("count", 0)
-    if used >= limit:
+    # 3) Charge the whole amount only if it fits in the remaining quota
+    used = None
+    if amount <= limit:
+        used = await _debit(db, user_id, service_name, limit, amount, entitlements.get("lb"))
+    if used is None:
+        audit_log.record(user_id, service_name, QUOTA_EXCEEDED, amount)
         raise HTTPException(status.HTTP_429_TOO_MANY_REQUESTS, detail=f"Monthly quota exceeded for {service_name}")
 
-    # 5) Increment and return
-    await db.usage.update_one({"_id": usage["_id"]}, {"$inc": {"count": 1}})
+    audit_log.record(user_id, service_name, ALLOWED, amount)
     return {
         "service": service_name,
-        "usage_this_month": used + 1,
+        "units": units,
+        "charged": amount,
+        "usage_this_month": used,
         "data": f"🚀 Simulated result from {service_name}"
     }
@@ -9,6 +9,13 @@ from app.auth import get_current_user, get_admin_user
 
 router = APIRouter(prefix="/subscriptions", tags=["subscriptions"])
 
+async def set_user_plan(db: AsyncIOMotorDatabase, user_id: ObjectId, plan: dict):
+    # Record the plan on the user so tokens carrying other entitlements go stale
+    await db.users.update_one(
+        {"_id": user_id},
+        {"$set": {"plan_id": plan["_id"], "plan_version": plan.get("version", 0)}}
+    )
+
 @router.post("", response_model=SubscriptionOut, status_code=status.HTTP_201_CREATED)
 async def subscribe(
     sub_in: SubscriptionCreate,
@@ -49,6 +56,7 @@ async def subscribe(
         }
         res = await db.subscriptions.insert_one(new_sub)
         doc = await db.subscriptions.find_one({"_id": res.inserted_id})
+    await set_user_plan(db, user_oid, plan)
 
     # Stringify ObjectIds for response
     doc["_id"] = str(doc["_id"])
@@ -120,6 +128,7 @@ async def assign_plan_to_user(
         new_sub = {"user_id": uid, "plan_id": plan_obj_id, "started_at": now}
         res = await db.subscriptions.insert_one(new_sub)
         doc = await db.subscriptions.find_one({"_id": res.inserted_id})
+    await set_user_plan(db, uid, plan)
     doc["_id"] = str(doc["_id"])
     doc["user_id"] = str(doc["user_id"])
     doc["plan_id"] = str(doc["plan_id"])
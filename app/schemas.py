@@ -1,7 +1,11 @@
 # app/schemas.py
 
 from pydantic import BaseModel, Field
-from typing import List, Dict, Optional, Literal
+from typing import Annotated, List, Dict, Optional, Literal
+
+# Caps on caller-supplied quantities; keeps units x cost well inside BSON's 64-bit ints
+MAX_UNITS = 10**6
+MAX_BATCH_ITEMS = 100
 
 # === Plan schemas ===
 
@@ -10,6 +14,8 @@ class PlanCreate(BaseModel):
     description: str
     permission_ids: List[str]
     limits: Dict[str, int]
+    lease_block: Optional[int] = Field(None, gt=0)  # reserve quota in blocks of this size
+    costs: Dict[str, Annotated[int, Field(gt=0, le=MAX_UNITS)]] = {}  # units charged per call, default 1
 
 class PlanOut(BaseModel):
     id: str = Field(..., alias="_id")
@@ -17,6 +23,9 @@ class PlanOut(BaseModel):
     description: str
     permissions: List[str]
     limits: Dict[str, int]
+    lease_block: Optional[int] = None
+    costs: Dict[str, int] = {}
+    version: int = 0
 
 
 # === Permission schemas ===
@@ -45,6 +54,16 @@ class SubscriptionOut(BaseModel):
     started_at: str
 
 
+# === Service schemas ===
+
+class ServiceUnits(BaseModel):
+    service: str
+    units: int = Field(1, ge=1, le=MAX_UNITS)
+
+class ServiceBatchRequest(BaseModel):
+    items: List[ServiceUnits] = Field(..., min_length=1, max_length=MAX_BATCH_ITEMS)
+
+
 # === Usage schemas ===
 
 class UsageOut(BaseModel):